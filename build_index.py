@@ -0,0 +1,33 @@
+# build_index.py
+# ──────────────────────────────────────────────────────────────────────────────
+# Offline build of the FAISS index (and the int8 ONNX query encoder export)
+# into HELPDESK_CACHE_DIR. The server and CLI only read these (see load_index).
+#
+#   python build_index.py           # build if the CSV / model changed
+#   python build_index.py --force   # re-encode and rebuild anyway
+# ──────────────────────────────────────────────────────────────────────────────
+
+import os
+import sys
+
+from helpdesk_faiss_chatbot import (
+    CACHE_DIR,
+    QueryEncoder,
+    build_index,
+    cache_paths,
+    load_corpus,
+)
+
+if __name__ == "__main__":
+    force = "--force" in sys.argv[1:]
+    embeddings_path, rows_path, index_path = cache_paths()
+    if os.path.exists(index_path) and os.path.exists(rows_path) and not force:
+        print(f"✅ Index up to date: {index_path}")
+    else:
+        if force and os.path.exists(embeddings_path):
+            os.remove(embeddings_path)  # don't rebuild from possibly bad cached vectors
+        print(f"✅ Wrote {build_index()} ({len(load_corpus())} tickets)")
+    try:
+        QueryEncoder.export(CACHE_DIR)  # export the ONNX query encoder once, not per worker
+    except ImportError:
+        pass  # optimum not installed: workers encode queries with PyTorch
@@ -1,80 +1,358 @@
+import asyncio
+import hashlib
+import json
+import os
+
 import pandas as pd
 import faiss
+import httpx
 import numpy as np
-import requests
+import torch
+from datasketch import MinHash, MinHashLSH
 from sentence_transformers import SentenceTransformer
 
 # === CONFIG ===
 CSV_PATH = "grouped_conversations.csv"
 TOP_K = 3
+# Below this cosine similarity the top match is treated as irrelevant and no history is sent
+MIN_SIM = float(os.getenv("HELPDESK_MIN_SIM", "0.35"))
 LLM_CONTEXT_LIMIT = 2000  # characters to feed to LLaMA
-OLLAMA_MODEL = "llama3.2:3b-instruct-q4_K_M"   # or "llama3:8b" / "llama3:70b" etc.
+OLLAMA_URL = "http://127.0.0.1:11434/api/generate"
+# Quantized 3B model + tight context: ~4 bits/weight and a small KV cache keep per-token decode fast
+MODEL_NAME = os.getenv("HELPDESK_MODEL", "llama3.2:3b-instruct-q4_K_M")
+NUM_CTX = int(os.getenv("HELPDESK_NUM_CTX", "1024"))
+NUM_PREDICT = int(os.getenv("HELPDESK_NUM_PREDICT", "512"))
+TEMPERATURE = float(os.getenv("HELPDESK_TEMP", "0.2"))
+OLLAMA_OPTIONS = {
+    "num_ctx": NUM_CTX,
+    "num_predict": NUM_PREDICT,
+    "num_keep": 0,
+    "temperature": TEMPERATURE,
+}
+EMBED_MODEL = "all-MiniLM-L6-v2"
+EMBED_HUB_ID = EMBED_MODEL if "/" in EMBED_MODEL else f"sentence-transformers/{EMBED_MODEL}"
+EMBED_MAX_SEQ_LENGTH = 256  # SentenceTransformer max_seq_length for all-MiniLM-L6-v2
+ENCODE_BATCH_SIZE = 256  # corpus encode batch; large batches keep the GPU busy
+CACHE_DIR = os.getenv("HELPDESK_CACHE_DIR", "cache")  # embeddings + trained index
+HNSW_M = 32  # graph neighbours per node
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 32
+DEDUP_THRESHOLD = 0.8  # Jaccard similarity above which tickets count as duplicates
+DEDUP_NUM_PERM = 64
+DEDUP_SHINGLE = 5  # character shingle length
+# CPU threads for torch / FAISS / ONNX Runtime; default leaves half the cores for Ollama
+NUM_THREADS = int(os.getenv("HELPDESK_TORCH_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+
+torch.set_num_threads(NUM_THREADS)
+faiss.omp_set_num_threads(NUM_THREADS)
 
 # === Load Helpdesk Conversations ===
-df = pd.read_csv(CSV_PATH)
-texts = df["actionbody"].tolist()
+def read_actionbodies() -> list:
+    """Every CSV row's `actionbody`, the build-time input to dedupe().
+
+    Rows are pre-truncated to LLM_CONTEXT_LIMIT (well past the encoder's
+    256-token window) and whitespace-only rows become "", so retrieval never
+    re-slices and blank tickets fall into the no-history prompt.
+    """
+    bodies = pd.read_csv(CSV_PATH)["actionbody"].fillna("").astype(str)
+    return [s[:LLM_CONTEXT_LIMIT] if s.strip() else "" for s in bodies]
+
+def load_corpus() -> list:
+    """Return the indexed tickets as a plain list; row i matches index id i.
+
+    Only the `actionbody` column is ever used, and list indexing keeps pandas
+    off the per-request path. Which CSV rows survived dedup is read from the
+    row-id file build_index() wrote next to the index, not recomputed.
+    """
+    _, rows_path, _ = cache_paths()
+    if not os.path.exists(rows_path):
+        raise FileNotFoundError(
+            f"No corpus row ids at {rows_path}; run `python build_index.py` first"
+        )
+    texts = read_actionbodies()
+    return [texts[i] for i in np.load(rows_path)]
+
+def dedupe(texts: list) -> list:
+    """Return the row ids to keep after dropping near-duplicates (MinHash-LSH).
+
+    The longest ticket of each cluster is kept. Shrinks the index and stops
+    one ticket repeated N times from crowding out top-k results. Ids are
+    returned in CSV order.
+    """
+    lsh = MinHashLSH(threshold=DEDUP_THRESHOLD, num_perm=DEDUP_NUM_PERM)
+    keep = []
+    # Longest first, so the first member seen of each cluster is its representative
+    for i in sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True):
+        text = texts[i]
+        m = MinHash(num_perm=DEDUP_NUM_PERM)
+        m.update_batch([text[j:j + DEDUP_SHINGLE].encode("utf-8")
+                        for j in range(max(1, len(text) - DEDUP_SHINGLE + 1))])
+        if lsh.query(m):
+            continue
+        lsh.insert(str(i), m)
+        keep.append(i)
+    keep.sort()
+    if len(keep) < len(texts):
+        print(f"Dropped {len(texts) - len(keep)} near-duplicate tickets")
+    return keep
 
 # === Load Sentence Transformer ===
-print("Loading sentence embedding model...")
-model = SentenceTransformer("all-MiniLM-L6-v2")
-embeddings = model.encode(texts, convert_to_numpy=True)
+def load_encoder() -> SentenceTransformer:
+    print("Loading sentence embedding model...")
+    model = SentenceTransformer(EMBED_MODEL)
+    if torch.cuda.is_available():
+        model = model.to("cuda").half()  # fp16 tensor cores, half the memory traffic
+    return model
+
+# === Embedding / Index Cache ===
+def cache_paths():
+    """Return (embeddings_path, rows_path, index_path) for the current CSV + settings.
+
+    Keyed by CSV contents, embedding model and everything dedupe() depends on,
+    so changing any of them forces a rebuild (and can never pair an index with
+    the wrong row ids), while plain restarts skip the corpus encode and index
+    training entirely.
+    """
+    with open(CSV_PATH, "rb") as f:
+        cache_key = hashlib.sha1(f.read()).hexdigest()[:12] + "-" + EMBED_MODEL.replace("/", "_")
+    cache_key += (f"-ctx{LLM_CONTEXT_LIMIT}"
+                  f"-dedup{DEDUP_THRESHOLD}x{DEDUP_NUM_PERM}s{DEDUP_SHINGLE}")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return (os.path.join(CACHE_DIR, f"{cache_key}.npy"),
+            os.path.join(CACHE_DIR, f"{cache_key}.rows.npy"),
+            os.path.join(CACHE_DIR, f"{cache_key}.hnsw-fp16.index"))
+
+def _save_npy(path: str, array: np.ndarray):
+    # Write then rename, so readers never see a half-written file
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+def encode_corpus(model: SentenceTransformer, texts) -> np.ndarray:
+    print("Encoding helpdesk conversations...")
+    # Encode in length order so each batch pads to a similar length, then
+    # scatter rows back to CSV order (index positions must match the corpus).
+    order = np.argsort([len(t) for t in texts])
+    emb_sorted = model.encode(
+        [texts[i] for i in order],
+        batch_size=ENCODE_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=True,
+    ).astype("float32", copy=False)  # FAISS wants float32 even when the model ran in fp16
+    embeddings = np.empty_like(emb_sorted)
+    embeddings[order] = emb_sorted
+    return embeddings
 
 # === Build FAISS Index ===
-dimension = embeddings.shape[1]
-index = faiss.IndexFlatL2(dimension)
-index.add(embeddings)
+def build_index() -> str:
+    """Dedupe + encode the corpus (or reuse cached embeddings), build the index and write it.
 
-# === LLaMA 3 via Ollama ===
-def generate_llama_response(prompt: str):
-    response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={
-            "model": OLLAMA_MODEL,
-            "prompt": prompt,
-            "stream": False
-        }
-    )
-    if response.status_code == 200:
-        return response.json()["response"].strip()
+    Offline step, run via build_index.py; the server only ever reads the result.
+    The kept CSV row ids are saved alongside, so load_corpus() lines up with
+    the index ids. The embedding model is only loaded on an embeddings cache
+    miss. Returns the index path.
+    """
+    embeddings_path, rows_path, index_path = cache_paths()
+    texts = read_actionbodies()
+    rows = dedupe(texts)
+    if os.path.exists(embeddings_path):
+        embeddings = np.load(embeddings_path)
     else:
-        raise RuntimeError(f"Ollama API error: {response.status_code} - {response.text}")
+        embeddings = encode_corpus(load_encoder(), [texts[i] for i in rows])
+        _save_npy(embeddings_path, embeddings)
+    # Unit vectors: inner product == cosine similarity (higher is closer)
+    faiss.normalize_L2(embeddings)
 
-# === Helpdesk Query Function ===
-def search_helpdesk(query):
-    query_embedding = model.encode([query])
-    distances, indices = index.search(np.array(query_embedding), TOP_K)
+    # HNSW graph over inner product: queries walk O(log N) nodes instead of scanning every row.
+    # Vectors are stored as fp16, halving the bytes read per distance computation.
+    index = faiss.IndexHNSWSQ(embeddings.shape[1], faiss.ScalarQuantizer.QT_fp16, HNSW_M,
+                              faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.train(embeddings)
+    index.add(embeddings)
+    _save_npy(rows_path, np.asarray(rows, dtype=np.int64))
+    # Write then rename, so a running worker never maps a half-written file
+    tmp_path = index_path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, index_path)
+    return index_path
 
-    best_idx = indices[0][0]
-    best_text = df.iloc[best_idx]["actionbody"]
+def load_index(mmap: bool = False):
+    """Read the prebuilt index for the current CSV + model.
 
-    if len(best_text) > LLM_CONTEXT_LIMIT:
-        best_text = best_text[:LLM_CONTEXT_LIMIT]
+    With mmap=True on a FAISS build that has IO_FLAG_MMAP_IFC, the HNSW graph
+    and SQ codes are memory-mapped read-only, so uvicorn workers share their
+    pages through the OS page cache. Older builds only know IO_FLAG_MMAP,
+    which maps IVF lists alone, so each worker still loads a private copy.
+    """
+    _, _, index_path = cache_paths()
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(
+            f"No FAISS index at {index_path}; run `python build_index.py` first"
+        )
+    flags = 0
+    if mmap:
+        if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+            flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+        else:
+            print("⚠️ This FAISS build lacks IO_FLAG_MMAP_IFC; the index is loaded "
+                  "privately in every worker (upgrade faiss to share it via mmap)")
+    index = faiss.read_index(index_path, flags)
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
 
-    # Prompt to LLaMA 3
-    prompt = f"""
-You are an expert IT helpdesk agent.
+# === Query Encoder (int8 ONNX Runtime) ===
+class QueryEncoder:
+    """Per-request query encoder backed by a dynamically int8-quantized ONNX export.
+
+    The corpus is still encoded by the SentenceTransformer; this only
+    replaces the single-query forward pass on the hot path. Only the ONNX
+    session and tokenizer are loaded; the PyTorch model is loaded as a
+    fallback when onnxruntime/transformers are missing, or when no export
+    exists yet and optimum isn't installed to create one.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.st_model = None
+        try:
+            self.session, self.tokenizer = self._load_session(cache_dir)
+        except ImportError as e:
+            print(f"ONNX query encoder unavailable ({e}); encoding queries with PyTorch")
+            self.session = None
+            self.st_model = load_encoder()
+
+    @staticmethod
+    def export(cache_dir: str) -> str:
+        """Export + int8-quantize the encoder into `cache_dir` once; return the .onnx path.
 
-The following is a historical helpdesk ticket conversation:
----
-{best_text}
----
+        The tokenizer is saved alongside, so serving needs neither optimum nor Hub access.
+        """
+        export_dir = os.path.join(cache_dir, "onnx-" + EMBED_MODEL.replace("/", "_"))
+        quantized_path = os.path.join(export_dir, "model_quantized.onnx")
+        if not os.path.exists(quantized_path):
+            from optimum.exporters.onnx import main_export
+            from optimum.onnxruntime import ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+            from transformers import AutoTokenizer
 
-A user now asks: "{query}"
+            print("Exporting query encoder to int8 ONNX...")
+            main_export(EMBED_HUB_ID, output=export_dir, task="feature-extraction")
+            quantizer = ORTQuantizer.from_pretrained(export_dir, file_name="model.onnx")
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=export_dir, quantization_config=qconfig)
+            AutoTokenizer.from_pretrained(EMBED_HUB_ID).save_pretrained(export_dir)
+        return quantized_path
 
-Based on the above, summarize the issue and resolution, then write a helpful and friendly support reply for the user.
-"""
+    @classmethod
+    def _load_session(cls, cache_dir: str):
+        import onnxruntime
+        from transformers import AutoTokenizer
 
-    reply = generate_llama_response(prompt)
+        quantized_path = cls.export(cache_dir)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = NUM_THREADS
+        session = onnxruntime.InferenceSession(quantized_path, sess_options=options,
+                                               providers=["CPUExecutionProvider"])
+        return session, AutoTokenizer.from_pretrained(os.path.dirname(quantized_path))
+
+    def encode(self, texts) -> np.ndarray:
+        """Return L2-normalized float32 embeddings, one row per text."""
+        if self.session is None:
+            return self.st_model.encode(
+                texts, convert_to_numpy=True, normalize_embeddings=True
+            ).astype("float32", copy=False)
+
+        enc = self.tokenizer(texts, padding=True, truncation=True,
+                             max_length=EMBED_MAX_SEQ_LENGTH, return_tensors="np")
+        input_names = {i.name for i in self.session.get_inputs()}
+        feeds = {k: v.astype(np.int64, copy=False) for k, v in enc.items() if k in input_names}
+        token_embeddings = self.session.run(None, feeds)[0]
+
+        # Mean pooling over non-pad tokens, matching the SentenceTransformer head
+        mask = enc["attention_mask"][..., None].astype(np.float32)
+        emb = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        emb = np.ascontiguousarray(emb, dtype=np.float32)
+        faiss.normalize_L2(emb)
+        return emb
+
+# === LLaMA 3 via Ollama ===
+async def generate_llama_response(client: httpx.AsyncClient, prompt: str):
+    """Yield reply pieces as Ollama streams them (NDJSON, one object per line)."""
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": prompt,
+        "stream": True,
+        "options": OLLAMA_OPTIONS,
+    }
+    async with client.stream("POST", OLLAMA_URL, json=payload) as response:
+        if response.status_code != 200:
+            text = await response.aread()
+            raise RuntimeError(f"Ollama API error: {response.status_code} - "
+                               f"{text.decode(errors='ignore')}")
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            if obj.get("done"):
+                return
+            yield obj.get("response", "")
+
+# === Helpdesk Query Function ===
+# Static prompt pieces, built once; each query only concatenates around them.
+_PROMPT_PREFIX = (
+    "You are an expert IT helpdesk agent.\n"
+    "\n"
+    "The following is a historical helpdesk ticket conversation:\n"
+    "---\n"
+)
+_PROMPT_MID = '\n---\n\nA user now asks: "'
+_PROMPT_SUFFIX = (
+    '"\n'
+    "\n"
+    "Based on the above, summarize the issue and resolution (if applicable), then write a "
+    "helpful and friendly support reply for the user. If the history is not directly relevant, "
+    "still provide a best-effort, step-by-step IT troubleshooting answer.\n"
+)
+
+
+def build_prompt(history: str, user_msg: str) -> str:
+    return _PROMPT_PREFIX + history + _PROMPT_MID + user_msg + _PROMPT_SUFFIX
+
+async def search_helpdesk(client: httpx.AsyncClient, query):
+    query_embedding = query_encoder.encode([query])
+    distances, indices = index.search(np.ascontiguousarray(query_embedding, dtype=np.float32), TOP_K)
+
+    best_idx = indices[0][0]
+    best_text = actionbodies[best_idx] if distances[0][0] >= MIN_SIM else ""
+
+    # Prompt to LLaMA 3
+    prompt = build_prompt(best_text, query)
 
     print(f"\n🔎 Query: {query}")
-    print(f"\n🤖 LLaMA 3 via Ollama says:\n{reply}\n")
+    print("\n🤖 LLaMA 3 via Ollama says:")
+    async for piece in generate_llama_response(client, prompt):
+        print(piece, end="", flush=True)
+    print("\n")
 
 # === CLI Chat Loop ===
-if __name__ == "__main__":
+# One client (and event loop) for the whole session, so the keep-alive
+# connection to Ollama is reused instead of reconnecting per question.
+async def chat_loop():
     print("🧠 Helpdesk Chatbot (FAISS + Ollama LLaMA 3) is ready!")
-    while True:
-        user_query = input("Ask a helpdesk question (or type 'exit'): ")
-        if user_query.lower() == "exit":
-            break
-        search_helpdesk(user_query)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
+        while True:
+            user_query = input("Ask a helpdesk question (or type 'exit'): ")
+            if user_query.lower() == "exit":
+                break
+            await search_helpdesk(client, user_query)
+
+if __name__ == "__main__":
+    actionbodies = load_corpus()
+    index = load_index()
+    if index.ntotal != len(actionbodies):
+        raise SystemExit(f"Index has {index.ntotal} rows but corpus has {len(actionbodies)}; "
+                         "run `python build_index.py --force`")
+    query_encoder = QueryEncoder(CACHE_DIR)
+    asyncio.run(chat_loop())
 
@@ -1,14 +1,22 @@
-import { NextResponse } from 'next/server';
+const BACKEND_URL = process.env.HELPDESK_BACKEND_URL || 'http://127.0.0.1:8000';
 
+// Proxy to the FastAPI NDJSON stream so tokens reach the browser as soon as
+// Ollama emits them, instead of waiting for the full reply.
 export async function POST(request) {
   const { message } = await request.json();
 
-  const res = await fetch('http://localhost:11434/api/generate', {
+  const res = await fetch(`${BACKEND_URL}/chat`, {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ model: 'llama3', prompt: message, stream: false }),
+    body: JSON.stringify({ message }),
   });
 
-  const json = await res.json();
-  return NextResponse.json({ reply: json.response.trim() });
+  return new Response(res.body, {
+    status: res.status,
+    headers: {
+      'Content-Type': 'application/x-ndjson',
+      'Cache-Control': 'no-cache',
+      'X-Accel-Buffering': 'no',
+    },
+  });
 }
@@ -32,8 +32,34 @@ export default function ChatbotUI() {
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ message: input }),
       });
-      const { reply } = await res.json();
-      setMessages(prev => [...prev, { from: 'ai', text: reply }]);
+      if (!res.ok || !res.body) throw new Error(`HTTP ${res.status}`);
+
+      // NDJSON stream: append each token to the AI bubble as it arrives
+      setMessages(prev => [...prev, { from: 'ai', text: '' }]);
+      const appendAi = text =>
+        setMessages(prev => {
+          const out = [...prev];
+          const last = out[out.length - 1];
+          out[out.length - 1] = { ...last, text: last.text + text };
+          return out;
+        });
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const obj = JSON.parse(line);
+          if (obj.error) throw new Error(obj.error);
+          if (obj.response) appendAi(obj.response);
+        }
+      }
     } catch {
       setMessages(prev => [
         ...prev,
@@ -2,19 +2,26 @@
 # ──────────────────────────────────────────────────────────────────────────────
 # FastAPI backend for IT Helpdesk AI with TRUE streaming from Ollama → SSE
 # - POST /query    : full JSON reply
+# - POST /chat     : NDJSON token stream (for non-SSE clients)
 # - GET  /chat-sse : Server-Sent Events (flushes each token immediately)
 # ──────────────────────────────────────────────────────────────────────────────
 
 import os
 os.environ.setdefault("TRANSFORMERS_NO_TORCHVISION", "1")  # avoid torchvision import issues
 
-from typing import AsyncIterator, Dict, Any
+from typing import AsyncIterator, Dict, Any, Tuple
 
 import asyncio
+import hashlib
 import json
 import logging
+import re
+import threading
+import time
+import unicodedata
 import numpy as np
 import httpx  # async HTTP client for streaming with Ollama
+from cachetools import LRUCache
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -23,21 +30,25 @@ from pydantic import BaseModel, Field
 
 # ── Project imports (provided by your repo)
 from helpdesk_faiss_chatbot import (
-    model,                    # sentence-transformers model
-    df,                       # dataframe with historical conversations
-    index,                    # FAISS index
+    QueryEncoder,             # int8 ONNX query encoder (PyTorch fallback)
+    build_prompt,             # RAG prompt shared with the CLI
+    load_corpus,              # historical conversations (actionbody list)
+    load_index,               # prebuilt FAISS index (see build_index.py)
+    CACHE_DIR,                # embeddings / index / ONNX export cache
     TOP_K,                    # top-k neighbors
-    LLM_CONTEXT_LIMIT,        # character/token budget for history
+    MIN_SIM,                  # cosine floor for injecting history
+    OLLAMA_URL,               # Ollama /api/generate endpoint
+    MODEL_NAME,               # quantized LLaMA tag
+    OLLAMA_OPTIONS,           # num_ctx / num_predict / num_keep / temperature
 )
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Config — tune these if you hit memory issues
+# (LLM model / num_ctx / num_predict live in helpdesk_faiss_chatbot)
 # ──────────────────────────────────────────────────────────────────────────────
-OLLAMA_URL   = "http://127.0.0.1:11434/api/generate"
-MODEL_NAME   = os.getenv("HELPDESK_MODEL", "llama3.2:3b-instruct-q4_K_M")  # light + fast
-NUM_CTX      = int(os.getenv("HELPDESK_NUM_CTX", "1024"))
-NUM_PREDICT  = int(os.getenv("HELPDESK_NUM_PREDICT", "512"))
-TEMPERATURE  = float(os.getenv("HELPDESK_TEMP", "0.2"))
+CACHE_SIZE   = int(os.getenv("HELPDESK_CACHE_SIZE", "1024"))  # LRU entries per cache
+ENCODE_BATCH = int(os.getenv("HELPDESK_ENCODE_BATCH", "32"))   # max queries per coalesced encode/search
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))  # match the Ollama server setting
 
 # ──────────────────────────────────────────────────────────────────────────────
 
@@ -54,6 +65,53 @@ app.add_middleware(
 
 log = logging.getLogger("uvicorn.error")
 
+# Shared Ollama client: keep-alive connections are pooled across requests
+# instead of opening a new TCP connection per generation.
+_ollama_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(60.0, read=60.0, write=60.0, connect=10.0),
+    limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30),
+)
+
+_ollama_sem = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+@app.on_event("startup")
+def _load_helpdesk():
+    """Load corpus, encoder and index once per worker before serving traffic.
+
+    Failures surface here at boot instead of on the first request. The index
+    is prebuilt by build_index.py and, on FAISS builds with IO_FLAG_MMAP_IFC,
+    memory-mapped read-only so workers share its pages through the OS cache
+    (see load_index).
+    """
+    app.state.actionbodies = load_corpus()
+    app.state.index = load_index(mmap=True)
+    if app.state.index.ntotal != len(app.state.actionbodies):
+        # Row ids would point at the wrong tickets; refuse to serve
+        raise RuntimeError(
+            f"Index has {app.state.index.ntotal} rows but corpus has "
+            f"{len(app.state.actionbodies)}; run `python build_index.py --force`"
+        )
+    app.state.query_encoder = QueryEncoder(CACHE_DIR)
+
+@app.on_event("startup")
+async def _start_coalesce_worker():
+    app.state.coalesce_worker = asyncio.create_task(_coalesce_worker())
+
+@app.on_event("shutdown")
+async def _close_ollama_client():
+    await _ollama_client.aclose()
+
+@app.on_event("shutdown")
+async def _stop_coalesce_worker():
+    app.state.coalesce_worker.cancel()
+
+# Recurring tickets skip work entirely: normalized query + history → LLM reply,
+# and normalized query → retrieved history (embed + FAISS search).
+_reply_cache: LRUCache = LRUCache(maxsize=CACHE_SIZE)
+_reply_cache_lock = asyncio.Lock()
+_history_cache: LRUCache = LRUCache(maxsize=CACHE_SIZE)
+_history_cache_lock = threading.Lock()
+
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Schemas
@@ -63,39 +121,81 @@ class ChatRequest(BaseModel):
     message: str = Field(..., description="User's query")
 
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Query coalescer (encode + search)
+# Requests enqueue their query and await a future; one background task drains
+# whatever is pending (up to ENCODE_BATCH), encodes it in a single batch, and
+# runs one FAISS search over the stacked (B, d) matrix. While a batch runs,
+# new arrivals pile up and form the next one.
+# ──────────────────────────────────────────────────────────────────────────────
+
+_pending: "asyncio.Queue[tuple[str, asyncio.Future]]" = asyncio.Queue()
+
+
+async def search_one(query: str) -> Tuple[int, float]:
+    """Return (best matching row, its cosine similarity) via the coalescer."""
+    fut = asyncio.get_running_loop().create_future()
+    await _pending.put((query, fut))
+    return await fut
+
+
+def _encode_and_search(batch) -> Tuple[np.ndarray, np.ndarray]:
+    Q = app.state.query_encoder.encode([q for q, _ in batch])
+    Q = np.ascontiguousarray(Q, dtype=np.float32)  # no-op for float32 rows
+    return app.state.index.search(Q, int(TOP_K))
+
+
+async def _coalesce_worker() -> None:
+    while True:
+        batch = [await _pending.get()]
+        while len(batch) < ENCODE_BATCH and not _pending.empty():
+            batch.append(_pending.get_nowait())
+        try:
+            distances, indices = await asyncio.to_thread(_encode_and_search, batch)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+        for (_, fut), dist, row in zip(batch, distances, indices):
+            if not fut.done():  # caller may have gone away
+                fut.set_result((int(row[0]), float(dist[0])))
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Retrieval + Prompt
 # ──────────────────────────────────────────────────────────────────────────────
 
-def retrieve_history(query: str) -> str:
+def normalize_query(query: str) -> str:
+    """Cache key for a query: NFKC, lowercased, whitespace collapsed."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query).lower().strip())
+
+
+def reply_cache_key(user_msg: str, history: str) -> str:
+    """Reply cache key: the normalized query plus the history it was answered with."""
+    return hashlib.sha1(f"{normalize_query(user_msg)}\0{history}".encode()).hexdigest()
+
+
+async def retrieve_history(query: str) -> str:
     """Return best matching prior helpdesk conversation text (or empty on failure)."""
+    key = normalize_query(query)
+    with _history_cache_lock:
+        cached = _history_cache.get(key)
+    if cached is not None:
+        return cached
     try:
-        q_emb = model.encode([query], convert_to_numpy=True)
-        distances, indices = index.search(np.array(q_emb), int(TOP_K))
-        best_idx = int(indices[0][0])
-        history = str(df.iloc[best_idx]["actionbody"])
+        best_idx, sim = await search_one(key)
+        # Irrelevant match: send no history rather than burn context on it;
+        # the prompt already covers the "not directly relevant" case.
+        history = app.state.actionbodies[best_idx] if sim >= MIN_SIM else ""
     except Exception:
         log.exception("Retrieval failed")
-        history = ""
-    if history and LLM_CONTEXT_LIMIT:
-        history = history[: int(LLM_CONTEXT_LIMIT)]
+        return ""  # don't cache failures
+    with _history_cache_lock:
+        _history_cache[key] = history
     return history
 
 
-def build_prompt(history: str, user_msg: str) -> str:
-    return f"""You are an expert IT helpdesk agent.
-
-The following is a historical helpdesk ticket conversation:
----
-{history}
----
-
-A user now asks: "{user_msg}"
-
-Based on the above, summarize the issue and resolution (if applicable), then write a helpful and friendly support reply for the user. If the history is not directly relevant, still provide a best-effort, step-by-step IT troubleshooting answer.
-"""
-
-
 # ──────────────────────────────────────────────────────────────────────────────
 # Ollama streaming → async generator (yields tokens as they arrive)
 # Ollama /api/generate with "stream": true returns NDJSON lines like:
@@ -110,15 +210,17 @@ async def ollama_stream(prompt: str) -> AsyncIterator[str]:
         "model": MODEL_NAME,
         "prompt": prompt,
         "stream": True,
-        "options": {
-            "num_ctx": NUM_CTX,
-            "num_predict": NUM_PREDICT,
-            "temperature": TEMPERATURE,
-        },
+        "options": OLLAMA_OPTIONS,
     }
-    timeout = httpx.Timeout(60.0, read=60.0, write=60.0, connect=10.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        async with client.stream("POST", OLLAMA_URL, json=payload) as resp:
+    # Hold one Ollama slot for the whole generation; beyond OLLAMA_NUM_PARALLEL
+    # Ollama would only queue the request and thrash its KV cache.
+    t0 = time.perf_counter()
+    async with _ollama_sem:
+        waited = time.perf_counter() - t0
+        if waited > 0.05:
+            log.info("Waited %.2fs for an Ollama slot (OLLAMA_NUM_PARALLEL=%d)",
+                     waited, OLLAMA_NUM_PARALLEL)
+        async with _ollama_client.stream("POST", OLLAMA_URL, json=payload) as resp:
             # Propagate Ollama errors (e.g., OOM)
             if resp.status_code >= 400:
                 text = await resp.aread()
@@ -162,6 +264,13 @@ async def ollama_stream(prompt: str) -> AsyncIterator[str]:
 # Routes
 # ──────────────────────────────────────────────────────────────────────────────
 
+# Keep proxies (nginx etc.) from buffering streamed responses
+STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
 @app.get("/", response_class=PlainTextResponse)
 def root():
     return "IT Helpdesk API is running. See /docs."
@@ -180,9 +289,15 @@ async def post_query(req: ChatRequest) -> Dict[str, Any]:
     if not user_msg:
         raise HTTPException(status_code=400, detail="Missing 'message'")
 
-    history = retrieve_history(user_msg)
+    history = await retrieve_history(user_msg)
     prompt = build_prompt(history, user_msg)
 
+    cache_key = reply_cache_key(user_msg, history)
+    async with _reply_cache_lock:
+        cached = _reply_cache.get(cache_key)
+    if cached is not None:
+        return {"reply": cached}
+
     # If you want to call Ollama non-streaming here, you can, but to keep simple:
     # we'll stream then join (so both code paths share the same logic).
     try:
@@ -196,41 +311,98 @@ async def post_query(req: ChatRequest) -> Dict[str, Any]:
         log.exception("LLM generation failed")
         raise HTTPException(status_code=500, detail=f"LLM error: {e}")
 
+    async with _reply_cache_lock:
+        _reply_cache[cache_key] = reply
     return {"reply": reply}
 
+def sse_frame(text: str) -> str:
+    """One SSE event carrying `text`; each line gets its own 'data:' field,
+    which EventSource joins back together with newlines."""
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+
 @app.get("/chat-sse")
 async def chat_sse(q: str):
     """
     Server-Sent Events endpoint used by the Next.js UI.
     Connect with: GET /chat-sse?q=...
-    Sends 'data: <token>\\n\\n' as soon as Ollama emits it,
-    then finishes with 'data: [END]\\n\\n'.
+    Sends one event per token as soon as Ollama emits it (or one event with
+    the whole reply on a cache hit), then finishes with 'data: [END]\\n\\n'.
     """
     user_msg = (q or "").strip()
     if not user_msg:
         return StreamingResponse(iter(["data: [error] missing query\n\n"]),
                                  media_type="text/event-stream")
 
-    history = retrieve_history(user_msg)
+    history = await retrieve_history(user_msg)
     prompt = build_prompt(history, user_msg)
 
+    cache_key = reply_cache_key(user_msg, history)
+    async with _reply_cache_lock:
+        cached = _reply_cache.get(cache_key)
+
     async def event_stream() -> AsyncIterator[str]:
+        if cached is not None:
+            yield sse_frame(cached)
+            yield "data: [END]\n\n"
+            return
         try:
+            out = []
             async for token in ollama_stream(prompt):
+                out.append(token)
                 # one token per SSE frame → browser flushes immediately
-                yield f"data: {token}\n\n"
+                yield sse_frame(token)
                 await asyncio.sleep(0)  # allow event loop to flush
+            async with _reply_cache_lock:
+                _reply_cache[cache_key] = "".join(out)
             yield "data: [END]\n\n"
         except HTTPException as he:
             yield f"data: [Backend error] {he.detail}\n\n"
         except Exception as e:
             yield f"data: [Backend error] {str(e)}\n\n"
 
-    headers = {
-        "Cache-Control": "no-cache",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",
-    }
     return StreamingResponse(event_stream(),
                              media_type="text/event-stream",
-                             headers=headers)
+                             headers=STREAM_HEADERS)
+
+@app.post("/chat")
+async def chat_stream(req: ChatRequest):
+    """
+    Streaming endpoint for non-SSE clients (fetch + ReadableStream).
+    Body: {"message": "..."}
+    Returns NDJSON: one {"response": "<token>", "done": false} line per token
+    as soon as Ollama emits it, then {"done": true} (or {"error": ..., "done": true}).
+    """
+    user_msg = (req.message or "").strip()
+    if not user_msg:
+        raise HTTPException(status_code=400, detail="Missing 'message'")
+
+    history = await retrieve_history(user_msg)
+    prompt = build_prompt(history, user_msg)
+
+    cache_key = reply_cache_key(user_msg, history)
+    async with _reply_cache_lock:
+        cached = _reply_cache.get(cache_key)
+
+    async def ndjson_stream() -> AsyncIterator[str]:
+        if cached is not None:
+            # One JSON line carries the whole reply; newlines are escaped, so no framing issue
+            yield json.dumps({"response": cached, "done": False}) + "\n"
+            yield json.dumps({"done": True}) + "\n"
+            return
+        try:
+            out = []
+            async for token in ollama_stream(prompt):
+                out.append(token)
+                yield json.dumps({"response": token, "done": False}) + "\n"
+            async with _reply_cache_lock:
+                _reply_cache[cache_key] = "".join(out)
+            yield json.dumps({"done": True}) + "\n"
+        except HTTPException as he:
+            yield json.dumps({"error": f"Backend error: {he.detail}", "done": True}) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": f"Backend error: {e}", "done": True}) + "\n"
+
+    return StreamingResponse(ndjson_stream(),
+                             media_type="application/x-ndjson",
+                             headers=STREAM_HEADERS)
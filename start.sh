@@ -7,6 +7,10 @@ export TRANSFORMERS_NO_TORCHVISION=1
 # If you use a venv, uncomment:
 # source .venv/bin/activate
 
+# 0) Build the FAISS index if the CSV / embedding model changed (no-op otherwise)
+echo "🟢 Checking FAISS index..."
+python build_index.py
+
 # 1) Start the FastAPI-powered server in the background
 echo "🟢 Starting Python FastAPI server on http://localhost:8000..."
 uvicorn server:app --reload &